@@ -1,12 +1,27 @@
 from io import BytesIO
 import ee
+import hashlib
+import json
+import math
 import streamlit as st
 import geemap.foliumap as geemap
 import geopandas as gpd
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import datashader as ds
+import datashader.transfer_functions as tf
+import spatialpandas as spd
+import sympy
+from sympy.parsing.sympy_parser import parse_expr
+from sympy.printing.precedence import precedence
+from sympy.printing.str import StrPrinter
+import numexpr as ne
+import numpy as np
+import shutil
 import zipfile
 import tempfile
-import os
+from pathlib import Path
+from indices_kernels import kernels as index_kernels
 
 
 def setup():
@@ -58,6 +73,32 @@ datasets = {
     }
 }
 
+# Compositors for the RGB preview; median is slower but kept for the index calculation
+compositors = ['mosaic', 'median', 'first']
+
+# Reduction scales in meters for the precision setting
+precisions = {
+    'Preview': 250,
+    'Balanced': 100,
+    'Precise': 30
+}
+
+# Index variables, in the order of the dataset bands
+band_names = ['RED', 'BLUE', 'GREEN', 'NIR', 'RED_EDGE']
+
+# Scale applied to downloaded bands so reflectance values fit the float16 range
+band_scale = 1e-4
+
+# Side of the square tiles the client-side index is evaluated over
+tile_size = 256
+
+# Most pixels downloaded in one request; Earth Engine refuses downloads over 48 MB, and each pixel carries the five
+# bands plus the mask as float32, so this leaves headroom for the projection stretching the bounds
+max_download_pixels = 1_500_000
+
+# NumExpr splits each tile across all cores
+ne.set_num_threads(ne.detect_number_of_cores())
+
 # Indexes
 indexes = {
     "NDVI": "(NIR - RED) / (NIR + RED)",
@@ -66,7 +107,7 @@ indexes = {
     "NDWI": "(GREEN - NIR) / (GREEN + NIR)",
     "GNDVI": "(NIR - GREEN) / (NIR + GREEN)",
     "NDRE": "(NIR - RED_EDGE) / (NIR + RED_EDGE)",
-    "MSAVI2": "(2 * NIR + 1 - sqrt(pow((2 * NIR + 1), 2) - 8 * (NIR - RED)) ) / 2",
+    "MSAVI2": "(2 * NIR + 1 - sqrt((2 * NIR + 1) ** 2 - 8 * (NIR - RED)) ) / 2",
     "ARVI": "(NIR - (2 * RED - BLUE)) / (NIR + (2 * RED - BLUE))",
     "PRI": "(RED - BLUE) / (RED + BLUE)",
     "WBI": "NIR / GREEN"
@@ -81,13 +122,14 @@ def mask_clouds(image, dataset):
     return image.updateMask(cloud_mask)
 
 
-# Function to get filtered images
-def get_filtered_images(satellite, year, region):
+# Function to filter images
+def filter_images(satellite, year, region):
     dataset = datasets[satellite]
     collection = ee.ImageCollection(dataset['collection'])
 
+    # Dates are built server-side so that year may also be a mapped ee.Number
     filtered_images = collection.filterBounds(region) \
-        .filterDate(f'{year}-01-01', f'{year}-12-31')
+        .filterDate(ee.Date.fromYMD(year, 1, 1), ee.Date.fromYMD(year, 12, 31))
 
     if satellite == 'Sentinel-2':
         return filtered_images.filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 20)) \
@@ -96,13 +138,23 @@ def get_filtered_images(satellite, year, region):
         return filtered_images.map(lambda image: mask_clouds(image, satellite))
 
 
+# Function to get filtered images, cached per satellite, year and region key
+@st.cache_resource(max_entries=32, show_spinner=False)
+def get_filtered_images(satellite, year, _region, region_key):
+    return filter_images(satellite, year, _region)
+
+
 # Function to add RGB layer to map
-def add_rgb_layer_to_map(m, satellite, year, region, brightness, clip, gamma):
-    filtered_images = get_filtered_images(satellite, year, region)
-    median_image = filtered_images.median()
+def add_rgb_layer_to_map(m, satellite, year, region, region_key, brightness, clip, gamma, compositor='mosaic'):
+    filtered_images = get_filtered_images(satellite, year, region, region_key)
+    composite_image = {
+        'mosaic': filtered_images.mosaic,
+        'first': filtered_images.first,
+        'median': filtered_images.median
+    }[compositor]()
 
     if clip:
-        median_image = median_image.clip(region)
+        composite_image = composite_image.clip(region)
 
     rgb_bands = [datasets[satellite]['bands'][i] for i in range(0, 3)]
 
@@ -113,46 +165,404 @@ def add_rgb_layer_to_map(m, satellite, year, region, brightness, clip, gamma):
         'gamma': gamma
     }
 
-    layer = m.addLayer(median_image, vis_params, f'{satellite} {year} RGB')
+    layer = m.addLayer(composite_image, vis_params, f'{satellite} {year} RGB')
     m.centerObject(region, 10)
     return layer
 
 
-# Function to calculate index
-def calc_index(satellite, index_name, year, region, clip):
-    filtered_images = get_filtered_images(satellite, year, region)
-    image = filtered_images.median()
+# Function to get the geometry of a region
+def region_geometry(region):
+    if isinstance(region, ee.FeatureCollection):
+        return region.geometry()
+    return region
+
+
+# Function to fetch the area of the bounding box of a region in square meters, which is what gets downloaded
+@st.cache_data(show_spinner=False)
+def region_bounds_area(_region, region_key):
+    return region_geometry(_region).bounds(1).area(1).getInfo()
+
+
+# Function to coarsen a download scale until the bounding box of a region fits in max_download_pixels
+def download_scale(region, region_key, scale):
+    return max(scale, math.ceil(math.sqrt(region_bounds_area(region, region_key) / max_download_pixels)))
+
+
+# Function to pick the reduction scale server-side from an area, coarsened for large regions unless full precision
+# is requested; this is the only copy of the formula, pick_scale evaluates it for the client-side paths
+def scale_for_area(area, precision):
+    scale = ee.Number(precisions[precision])
+    if precision == 'Precise':
+        return scale
+    return scale.max(ee.Number(area).sqrt().divide(512).int())
+
+
+# Function to fetch the reduction scale of a region, as _calc_index_summary picks it
+@st.cache_data(show_spinner=False)
+def pick_scale(_region, region_key, precision):
+    return scale_for_area(region_geometry(_region).area(1), precision).getInfo()
 
+
+# Function to build a region from its client-side GeoJSON string, cached on the region key rather than the
+# GeoJSON so the map layers and the statistics share one region object without hashing the geometry each rerun
+@st.cache_resource(max_entries=32, show_spinner=False)
+def geojson_to_region(_region_json, region_key):
+    region_geojson = json.loads(_region_json)
+    if region_geojson['type'] == 'FeatureCollection':
+        return geemap.geojson_to_ee(region_geojson, geodesic=True)
+    return ee.Geometry(region_geojson)
+
+
+# Function to get the Earth Engine region, GeoJSON string and region key of a point; the short GeoJSON string
+# is its own key
+def get_point(long, lat):
+    point_json = json.dumps({'type': 'Point', 'coordinates': [long, lat]}, sort_keys=True)
+    return geojson_to_region(point_json, point_json), point_json, point_json
+
+
+# Printer that emits every numeric literal as a float, so the optimized expressions add no integer arithmetic
+class ExpressionPrinter(StrPrinter):
+    def _print_Integer(self, expr):
+        return repr(float(expr))
+
+    def _print_Rational(self, expr):
+        return repr(float(expr))
+
+    # Keep a fractional coefficient as one factor, e.g. SAVI's folded 3/2, instead of splitting it into a
+    # numerator and a denominator
+    def _print_Mul(self, expr):
+        coeff, term = expr.as_coeff_Mul()
+        if coeff.is_Rational and not coeff.is_Integer:
+            return f'{float(coeff)!r}*{self.parenthesize(term, precedence(expr), strict=True)}'
+        return super()._print_Mul(expr)
+
+
+# Optimized index expressions, filled on first use
+index_expr_cache = {}
+
+
+# Function to check whether a subexpression is too small to be worth its own expression node, e.g. 2*RED
+def is_trivial_subexpression(expr):
+    if expr.is_Symbol:
+        return True
+    return expr.is_Mul and len(expr.args) == 2 and any(arg.is_Number for arg in expr.args) \
+        and any(arg.is_Symbol for arg in expr.args)
+
+
+# Function to optimize an index expression with constant folding and common subexpression elimination
+def optimize_index_expression(index_name):
+    if index_name not in index_expr_cache:
+        symbols = {name: sympy.Symbol(name) for name in band_names + ['L']}
+        # Parse without evaluation so sympy does not distribute constants and hide repeated terms such as
+        # MSAVI2's (2 * NIR + 1); substituting L still folds SAVI's constants
+        expression = parse_expr(indexes[index_name], local_dict=symbols, evaluate=False) \
+            .subs(symbols['L'], sympy.Rational(1, 2))
+        replacements, (reduced,) = sympy.cse(expression)
+
+        # Inline trivial subexpressions back into the expressions that use them
+        trivial = {}
+        kept = []
+        with sympy.evaluate(False):
+            for symbol, sub_expression in replacements:
+                sub_expression = sub_expression.xreplace(trivial)
+                if is_trivial_subexpression(sub_expression):
+                    trivial[symbol] = sub_expression
+                else:
+                    kept.append((symbol, sub_expression))
+            reduced = reduced.xreplace(trivial)
+
+        printer = ExpressionPrinter()
+        index_expr_cache[index_name] = (
+            [(str(symbol), printer.doprint(sub_expression)) for symbol, sub_expression in kept],
+            printer.doprint(reduced)
+        )
+
+    return index_expr_cache[index_name]
+
+
+# Function to apply the index expression to a composite image
+def index_expression(image, satellite, index_name):
     red_band = datasets[satellite]['bands'][0]
     blue_band = datasets[satellite]['bands'][1]
     green_band = datasets[satellite]['bands'][2]
     nir_band = datasets[satellite]['bands'][3]
     red_edge_band = datasets[satellite]['bands'][4]
 
-    if clip:
-        image = image.clip(region)
-
-    index = image.expression(indexes[index_name], {
+    variables = {
         'RED': image.select(red_band),
         'BLUE': image.select(blue_band),
         'GREEN': image.select(green_band),
         'NIR': image.select(nir_band),
-        'RED_EDGE': image.select(red_edge_band),
-        'L': 0.5
-    }).rename(index_name)
+        'RED_EDGE': image.select(red_edge_band)
+    }
+
+    # Evaluate the common subexpressions once and reference them by name in the reduced expression
+    replacements, expression = optimize_index_expression(index_name)
+    for symbol, sub_expression in replacements:
+        variables[symbol] = image.expression(sub_expression, variables)
+
+    return image.expression(expression, variables).rename(index_name)
+
+
+# Function to build an image with every index as a band, cached so index changes share one composite
+@st.cache_resource(max_entries=32, show_spinner=False)
+def build_index_image(satellite, year, _region, region_key, clip):
+    filtered_images = get_filtered_images(satellite, year, _region, region_key)
+    image = filtered_images.median()
+
+    if clip:
+        image = image.clip(_region)
+
+    return ee.Image.cat([index_expression(image, satellite, name) for name in indexes])
+
+
+# Function to build index image
+def build_index(satellite, index_name, year, region, region_key, clip):
+    return build_index_image(satellite, year, region, region_key, clip).select(index_name)
+
+
+# Function to build the statistics reducer
+def stats_reducer():
+    return ee.Reducer.mean().combine(
+        reducer2=ee.Reducer.minMax(), sharedInputs=True
+    ).combine(
+        reducer2=ee.Reducer.stdDev(), sharedInputs=True
+    )
+
+
+# Function to calculate index statistics together with the region area, image count and scale in a single
+# request, cached on disk so repeated reruns and restarts skip the Earth Engine round-trip; the cache key is the
+# region key, since the region GeoJSON string is too large to hash on every rerun, and the entries are bounded
+# since disk-persisted caches ignore ttl
+@st.cache_data(max_entries=256, show_spinner=False, persist='disk')
+def _calc_index_summary(satellite, index_name, year, _region_json, region_key, clip, precision):
+    region = geojson_to_region(_region_json, region_key)
+    index = build_index(satellite, index_name, year, region, region_key, clip)
+    area = region_geometry(region).area(1)
+    scale = scale_for_area(area, precision)
 
     stats = index.reduceRegion(
-        reducer=ee.Reducer.mean().combine(
-            reducer2=ee.Reducer.minMax(), sharedInputs=True
-        ).combine(
-            reducer2=ee.Reducer.stdDev(), sharedInputs=True
-        ),
+        reducer=stats_reducer(),
         geometry=region,
-        scale=30,
+        scale=scale,
+        maxPixels=1e9,
         bestEffort=True
-    ).getInfo()
+    )
+
+    return ee.Dictionary({
+        'stats': stats,
+        'area': area,
+        'count': filter_images(satellite, year, region).size(),
+        'scale': scale
+    }).getInfo()
+
+
+# Function to calculate index statistics together with the region area, image count and scale
+def calc_index(satellite, index_name, year, region_json, region_key, clip, precision='Precise'):
+    return _calc_index_summary(satellite, index_name, year, region_json, region_key, clip, precision)
+
+
+# Function to calculate index statistics for every year server-side, cached on the region key like
+# _calc_index_summary
+@st.cache_data(show_spinner=False, ttl=3600)
+def _calc_index_timeseries_stats(satellite, index_name, years, _region_json, region_key, scale):
+    region = geojson_to_region(_region_json, region_key)
+
+    # The mapped year is a server-side value, so the cached collection lookup is bypassed here
+    def year_stats(year):
+        index = index_expression(filter_images(satellite, year, region).median(), satellite, index_name)
+        stats = index.reduceRegion(
+            reducer=stats_reducer(),
+            geometry=region,
+            scale=scale,
+            maxPixels=1e9,
+            bestEffort=True
+        )
+        return ee.Dictionary(stats).set('year', year)
+
+    return ee.List(years).map(year_stats).getInfo()
+
+
+# Function to calculate index statistics over a range of years in a single request
+def calc_index_timeseries(satellite, index_name, years, region_json, region_key, scale=30):
+    return _calc_index_timeseries_stats(satellite, index_name, list(years), region_json, region_key, scale)
+
+
+# Directory uploaded shapefiles are extracted to, one subdirectory per file hash
+extract_root = Path.home() / '.cache' / 'sat_app'
+
+# Number of uploaded regions kept in the session and on disk, most recently used last
+max_rois = 5
+
+
+# Function to remove all but the most recently used extracted uploads, leaving extractions in progress alone;
+# another session may remove a directory while this one looks at it, so vanished entries are skipped
+def prune_extracted():
+    extracted = []
+    for path in extract_root.iterdir():
+        if path.name.startswith('.'):
+            continue
+        try:
+            extracted.append((path.stat().st_mtime, path))
+        except FileNotFoundError:
+            continue
+
+    extracted.sort(reverse=True)
+    for _, path in extracted[max_rois:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+# Function to load a zipped shapefile, cached on the file hash so reruns skip the extraction
+@st.cache_data(max_entries=max_rois, show_spinner=False)
+def load_roi(file_hash, _file_bytes):
+    extract_dir = extract_root / file_hash
+
+    # Extract the zip file, unless an earlier run already has; extracting next to the target and renaming
+    # means a half-extracted directory is never picked up
+    if not extract_dir.exists():
+        extract_root.mkdir(parents=True, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(prefix='.extract-', dir=extract_root)
+        try:
+            with zipfile.ZipFile(BytesIO(_file_bytes), 'r') as zip_ref:
+                zip_ref.extractall(tmpdir)
+            Path(tmpdir).rename(extract_dir)
+        except (OSError, zipfile.BadZipFile):
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            # Another session may have extracted the same upload in the meantime
+            if not extract_dir.exists():
+                return None, None
+        prune_extracted()
+    else:
+        # Mark the extraction as recently used so pruning keeps it
+        extract_dir.touch()
+
+    # Find the shapefile within the extracted files
+    shapefile_path = next(extract_dir.rglob('*.shp'), None)
 
-    return index, stats
+    if not shapefile_path:
+        return None, None
+
+    # Read the shapefile into a GeoDataFrame
+    gdf = gpd.read_file(shapefile_path)
+
+    # Earth Engine expects lon/lat, so the GeoJSON is reprojected while the GeoDataFrame keeps its own CRS; it is
+    # serialized with sorted keys so the same upload always gives the same string
+    wgs84_gdf = gdf.to_crs(4326) if gdf.crs is not None else gdf
+    return gdf, wgs84_gdf.to_json(sort_keys=True)
+
+
+# Function to get the GeoDataFrame, Earth Engine region, GeoJSON string and region key of an uploaded shapefile,
+# shared by all pages so switching pages does not convert the same upload again; the region key is the hash of
+# the upload, which the GeoJSON string follows from
+def get_roi(uploaded_file):
+    file_bytes = uploaded_file.getvalue()
+    key = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+    rois = st.session_state.setdefault('rois', {})
+
+    if key in rois:
+        rois[key] = rois.pop(key)
+    else:
+        gdf, roi_json = load_roi(key, file_bytes)
+        if gdf is None or gdf.empty:
+            roi = roi_json = None
+        else:
+            roi = geojson_to_region(roi_json, key)
+        rois[key] = (gdf, roi, roi_json, key)
+        if len(rois) > max_rois:
+            rois.pop(next(iter(rois)))
+
+    return rois[key]
+
+
+# Function to plot a GeoDataFrame; polygon layers are rasterized with Datashader, other geometries are drawn
+# with GeoPandas
+def plot_gdf(gdf, width=600):
+    fig, ax = session_figure('roi_figure')
+
+    if gdf.geom_type.isin(['Polygon', 'MultiPolygon']).all():
+        # Keep the aspect ratio of the bounds so the raster is not stretched
+        x_min, y_min, x_max, y_max = gdf.total_bounds
+        height = max(1, min(width, int(width * (y_max - y_min) / max(x_max - x_min, 1e-9))))
+
+        canvas = ds.Canvas(plot_width=width, plot_height=height, x_range=(x_min, x_max), y_range=(y_min, y_max))
+        agg = canvas.polygons(spd.GeoDataFrame(gdf), geometry='geometry', agg=ds.count())
+        ax.imshow(tf.shade(agg, cmap='#1f77b4').to_pil(), extent=(x_min, x_max, y_min, y_max))
+    else:
+        gdf.plot(ax=ax)
+
+    ax.tick_params(axis='x', labelrotation=90, labelsize=7)
+    ax.tick_params(axis='y', labelsize=7)
+    return fig
+
+
+# Function to get a figure kept in the session, with its axes cleared for redrawing
+def session_figure(key):
+    if key not in st.session_state:
+        fig = Figure()
+        fig.subplots()
+        st.session_state[key] = fig
+
+    fig = st.session_state[key]
+    ax = fig.axes[0]
+    ax.clear()
+    return fig, ax
+
+
+# Function to render a figure to PNG directly on an Agg canvas, bypassing pyplot
+def figure_png(fig):
+    buf = BytesIO()
+    FigureCanvasAgg(fig).print_png(buf)
+    buf.seek(0)
+    return buf
+
+
+# Function to download the index bands of a region as scaled float16 arrays, with masked pixels set to NaN; an
+# entry can take up to 15 MB, so only a few are kept
+@st.cache_data(max_entries=4, show_spinner=False)
+def download_bands(satellite, year, _region_json, region_key, scale):
+    region = geojson_to_region(_region_json, region_key)
+    image = filter_images(satellite, year, region).median().clip(region)
+    image = image.select(datasets[satellite]['bands'], band_names).toFloat()
+    image = image.addBands(image.mask().reduce(ee.Reducer.min()).rename('VALID'))
+
+    array = geemap.ee_to_numpy(image, region=region_geometry(region), scale=scale)
+    valid = array[:, :, -1] > 0
+
+    return {name: (np.where(valid, array[:, :, i], np.nan).astype(np.float32) * band_scale).astype(np.float16)
+            for i, name in enumerate(band_names)}
+
+
+# Function to calculate index statistics client-side, reusing the downloaded bands across index changes
+def calc_index_local(satellite, index_name, year, region_json, region_key, scale=30):
+    bands = download_bands(satellite, year, region_json, region_key, scale)
+    height, width = bands['RED'].shape
+    values = np.empty((height, width), dtype=np.float32)
+
+    # Evaluate tile by tile so the float32 working copies stay in cache
+    for iy in range(0, height, tile_size):
+        for ix in range(0, width, tile_size):
+            window = (slice(iy, iy + tile_size), slice(ix, ix + tile_size))
+            # Work in the original units so the results match the Earth Engine statistics
+            tile = {name: band[window].astype(np.float32) / np.float32(band_scale) for name, band in bands.items()}
+
+            # Indices with sqrt or repeated terms use the Numba kernels, the rest go through NumExpr
+            if index_name in index_kernels:
+                kernel, kernel_bands = index_kernels[index_name]
+                kernel(*[tile[name] for name in kernel_bands], values[window])
+            else:
+                ne.evaluate(indexes[index_name], local_dict={**tile, 'L': np.float32(0.5)},
+                            out=values[window], casting='same_kind')
+
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return {f"{index_name}_{stat}": None for stat in ['min', 'mean', 'max', 'stdDev']}
+
+    return {
+        f"{index_name}_min": float(np.nanmin(values)),
+        f"{index_name}_mean": float(np.nanmean(values)),
+        f"{index_name}_max": float(np.nanmax(values)),
+        f"{index_name}_stdDev": float(np.nanstd(values))
+    }
 
 
 def main():
@@ -163,10 +573,8 @@ def main():
     row1_col1, row1_col2 = st.columns([5, 1])
     row2_col1, row2_col2, row2_col3 = st.columns([1, 1, 1])
 
-    Map = geemap.Map()
-
-    roi = None
-    coordinates = None
+    roi = roi_key = None
+    coordinates = coordinates_key = None
 
     st.sidebar.markdown("""---""")
     st.sidebar.markdown("<h5 style='text-align: center; color: grey;'>Set point of interest</h5>",
@@ -178,50 +586,26 @@ def main():
         lat = st.number_input('Latitude', value=0.0)
 
     if long != 0 and lat != 0:
-        coordinates = ee.Geometry.Point([long, lat])
+        coordinates, _, coordinates_key = get_point(long, lat)
 
     st.sidebar.markdown("<h3 style='text-align: center; color: grey;'>OR</h3>", unsafe_allow_html=True)
 
     # Upload a zipped shapefile
     uploaded_shp_file = st.sidebar.file_uploader("Upload a Zipped Shapefile", type=["zip"])
 
-    if uploaded_shp_file is not None:
-        # Extract the zip file
-        with tempfile.TemporaryDirectory() as tmpdir:
-            with zipfile.ZipFile(uploaded_shp_file, 'r') as zip_ref:
-                zip_ref.extractall(tmpdir)
+    st.sidebar.markdown("""---""")
+    precision = st.sidebar.select_slider("Precision", options=list(precisions.keys()), value='Balanced')
 
-            # Find the shapefile within the extracted files
-            shapefile_path = None
-            for root, dirs, files in os.walk(tmpdir):
-                for file in files:
-                    if file.endswith(".shp"):
-                        shapefile_path = os.path.join(root, file)
-                        break
-
-            if shapefile_path:
-                # Read the shapefile into a GeoDataFrame
-                gdf = gpd.read_file(shapefile_path)
-
-                # Create the plot
-                fig, ax = plt.subplots()
-                gdf.plot(ax=ax)
-                plt.xticks(rotation=90, fontsize=7)
-                plt.yticks(fontsize=7)
-
-                # Save the plot to a BytesIO object
-                buf = BytesIO()
-                plt.savefig(buf, format='png')
-                buf.seek(0)
-
-                # Display the plot in Streamlit
-                with row2_col1:
-                    st.image(buf, caption='Geopandas Plot')
-            else:
-                st.error("Shapefile (.shp) not found in the uploaded zip file.")
+    if uploaded_shp_file is not None:
+        gdf, roi, roi_json, roi_key = get_roi(uploaded_shp_file)
 
+        if gdf is not None:
+            # Display the plot in Streamlit
             if not gdf.empty:
-                roi = geemap.geopandas_to_ee(gdf)
+                with row2_col1:
+                    st.image(figure_png(plot_gdf(gdf)), caption='Region of interest')
+        else:
+            st.error("Shapefile (.shp) not found in the uploaded zip file, or the zip file could not be read.")
 
     with row0_col1:
         sat = st.selectbox("Select a satellite", list(datasets.keys()), index=0)
@@ -243,29 +627,57 @@ def main():
         clip = st.toggle("Clip")
 
     with row1_col2:
+        compositor = st.selectbox("Compositor", compositors, index=0)
         check_index = st.toggle("Add Index")
+        index_name = main_color = mid_color = secondary_color = None
         if check_index:
             index_name = st.selectbox("Select index", list(indexes.keys()), index=0)
+            compute_locally = st.toggle("Compute locally")
             main_color = st.color_picker('Main color', value='#00ff00')
             mid_color = st.color_picker('Mid color', value='#ffff00')
             secondary_color = st.color_picker("Secondary color", value='#ff0000')
 
-    if coordinates is not None and roi is None:
+    # Keep the map across reruns and only rebuild its layers when something drawn on it changes
+    map_sig = (sat, selected_year, long, lat, roi_key, brightness, gamma, clip, compositor, check_index, index_name,
+               main_color, mid_color, secondary_color)
+    rebuild_map = 'map' not in st.session_state or st.session_state.map_sig != map_sig
+    if rebuild_map:
+        st.session_state.map = geemap.Map()
+        st.session_state.map_sig = map_sig
+    Map = st.session_state.map
+
+    if coordinates is not None and roi is None and rebuild_map:
         Map.centerObject(coordinates, zoom=10)
-        add_rgb_layer_to_map(Map, sat, selected_year, coordinates, brightness, None, gamma)
+        add_rgb_layer_to_map(Map, sat, selected_year, coordinates, coordinates_key, brightness, None, gamma,
+                             compositor)
 
     if selected_year is not None and sat is not None and roi is not None:
-        Map.centerObject(roi, zoom=10)
+        if rebuild_map:
+            Map.centerObject(roi, zoom=10)
 
-        add_rgb_layer_to_map(Map, sat, selected_year, roi, brightness, clip, gamma)
+            add_rgb_layer_to_map(Map, sat, selected_year, roi, roi_key, brightness, clip, gamma, compositor)
 
         if check_index:
-            index_image, stats = calc_index(sat, index_name, selected_year, roi, clip)
-            Map.addLayer(index_image, {'min': -1, 'max': 1, 'palette': [secondary_color, mid_color, main_color]},
-                         f'{index_name},{sat} {selected_year}')
+            summary = stats = None
+            if compute_locally:
+                scale = pick_scale(roi, roi_key, precision)
+                local_scale = download_scale(roi, roi_key, scale)
+                if local_scale > scale:
+                    st.warning(f"Region too large to download at {scale} m, using {local_scale} m instead.")
+                try:
+                    stats = calc_index_local(sat, index_name, selected_year, roi_json, roi_key, local_scale)
+                except ee.EEException as e:
+                    st.error(f"Downloading the bands failed, computing on Earth Engine instead: {e}")
+            if stats is None:
+                summary = calc_index(sat, index_name, selected_year, roi_json, roi_key, clip, precision)
+                stats = summary['stats']
+            if rebuild_map:
+                index_image = build_index(sat, index_name, selected_year, roi, roi_key, clip)
+                Map.addLayer(index_image, {'min': -1, 'max': 1, 'palette': [secondary_color, mid_color, main_color]},
+                             f'{index_name},{sat} {selected_year}')
             with row2_col2:
                 # Plot a bar chart of index statistics
-                fig, ax = plt.subplots()
+                fig, ax = session_figure('stats_figure')
                 labels = ['Min', 'Mean', 'Max', 'Std Dev']
                 values = [stats[f"{index_name}_min"], stats[f"{index_name}_mean"],
                           stats[f"{index_name}_max"], stats[f"{index_name}_stdDev"]]
@@ -273,15 +685,20 @@ def main():
                 ax.set_title(f'{index_name} Statistics')
                 ax.set_ylabel('Value')
                 ax.set_xlabel('Statistics')
-                st.pyplot(fig)
+                st.image(figure_png(fig))
                 with row2_col3:
                     st.subheader(f"{index_name} Statistics")
                     st.write("Min:", stats[f"{index_name}_min"])
                     st.write("Mean:", stats[f"{index_name}_mean"])
                     st.write("Max:", stats[f"{index_name}_max"])
                     st.write("Std Dev:", stats[f"{index_name}_stdDev"])
+                    if summary is not None:
+                        st.write("Area (km²):", round(summary['area'] / 1e6, 2))
+                        st.write("Images:", summary['count'])
+                        st.write("Scale (m):", summary['scale'])
 
-        Map.add_gdf(gdf, 'polygon')
+        if rebuild_map:
+            Map.add_gdf(gdf, 'polygon')
 
     with row1_col1:
         Map.to_streamlit(height=600)
@@ -0,0 +1,14 @@
+from numba.pycc import CC
+from indices_kernels import arvi_kernel, evi_kernel, msavi2_kernel
+
+# Ahead-of-time compiled index kernels, imported by indices_kernels.py in place of the JIT ones when
+# SAT_APP_AOT_KERNELS is set. Opt-in only: they run single-threaded, and numba.pycc is pending deprecation
+cc = CC('indices')
+
+cc.export('msavi2_f32', 'void(f4[:,:], f4[:,:], f4[:,:])')(msavi2_kernel)
+cc.export('evi_f32', 'void(f4[:,:], f4[:,:], f4[:,:], f4[:,:])')(evi_kernel)
+cc.export('arvi_f32', 'void(f4[:,:], f4[:,:], f4[:,:], f4[:,:])')(arvi_kernel)
+
+
+if __name__ == "__main__":
+    cc.compile()
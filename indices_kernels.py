@@ -0,0 +1,87 @@
+import os
+import numpy as np
+from numba import njit, prange
+
+# Fast-math flags without 'nnan' and 'ninf', since masked pixels are NaN
+fastmath_flags = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+# Side of the square blocks the kernels hand out to threads
+block_size = 64
+
+
+# Function to count the blocks covering an array
+@njit(cache=True)
+def count_blocks(height, width):
+    blocks_x = (width + block_size - 1) // block_size
+    blocks_y = (height + block_size - 1) // block_size
+    return blocks_x, blocks_x * blocks_y
+
+
+# Function to get the pixel bounds of a block
+@njit(cache=True)
+def block_bounds(block, blocks_x, height, width):
+    y0 = (block // blocks_x) * block_size
+    x0 = (block % blocks_x) * block_size
+    return y0, min(y0 + block_size, height), x0, min(x0 + block_size, width)
+
+
+# The kernels below are plain functions so build_indices.py can also compile them ahead of time; divisions by
+# zero are written out as NaN because the ahead-of-time compiler raises on them instead of returning inf
+
+# MSAVI2 kernel
+def msavi2_kernel(nir, red, out):
+    height, width = out.shape
+    blocks_x, blocks = count_blocks(height, width)
+    one, two, eight = np.float32(1), np.float32(2), np.float32(8)
+    for block in prange(blocks):
+        y0, y1, x0, x1 = block_bounds(block, blocks_x, height, width)
+        for y in range(y0, y1):
+            for x in range(x0, x1):
+                t = two * nir[y, x] + one
+                out[y, x] = (t - np.sqrt(t * t - eight * (nir[y, x] - red[y, x]))) / two
+
+
+# EVI kernel
+def evi_kernel(nir, red, blue, out):
+    height, width = out.shape
+    blocks_x, blocks = count_blocks(height, width)
+    zero, one, gain, c1, c2 = np.float32(0), np.float32(1), np.float32(2.5), np.float32(6), np.float32(7.5)
+    for block in prange(blocks):
+        y0, y1, x0, x1 = block_bounds(block, blocks_x, height, width)
+        for y in range(y0, y1):
+            for x in range(x0, x1):
+                d = nir[y, x] + c1 * red[y, x] - c2 * blue[y, x] + one
+                out[y, x] = gain * (nir[y, x] - red[y, x]) / d if d != zero else np.nan
+
+
+# ARVI kernel
+def arvi_kernel(nir, red, blue, out):
+    height, width = out.shape
+    blocks_x, blocks = count_blocks(height, width)
+    zero, two = np.float32(0), np.float32(2)
+    for block in prange(blocks):
+        y0, y1, x0, x1 = block_bounds(block, blocks_x, height, width)
+        for y in range(y0, y1):
+            for x in range(x0, x1):
+                rb = two * red[y, x] - blue[y, x]
+                d = nir[y, x] + rb
+                out[y, x] = (nir[y, x] - rb) / d if d != zero else np.nan
+
+
+# The parallel JIT kernels are the default; cache=True keeps their compiled code on disk, so only the very first
+# call pays the warmup. The ahead-of-time kernels from build_indices.py skip even that but run single-threaded,
+# since pycc ignores prange and fastmath, so they are only used when SAT_APP_AOT_KERNELS is set
+if os.environ.get('SAT_APP_AOT_KERNELS'):
+    import indices
+    msavi2, evi, arvi = indices.msavi2_f32, indices.evi_f32, indices.arvi_f32
+else:
+    jit = njit(parallel=True, fastmath=fastmath_flags, error_model='numpy', cache=True)
+    msavi2, evi, arvi = jit(msavi2_kernel), jit(evi_kernel), jit(arvi_kernel)
+
+
+# Kernels by index name, with the bands they take in order before the output array
+kernels = {
+    'MSAVI2': (msavi2, ['NIR', 'RED']),
+    'EVI': (evi, ['NIR', 'RED', 'BLUE']),
+    'ARVI': (arvi, ['NIR', 'RED', 'BLUE'])
+}
@@ -1,13 +1,7 @@
-import ee
 import pandas as pd
 import streamlit as st
-import geemap.foliumap as geemap
-import geopandas as gpd
-import matplotlib.pyplot as plt
-import zipfile
-import tempfile
-import os
-from app import Navbar, calc_index, datasets, indexes
+from app import Navbar, calc_index, calc_index_timeseries, datasets, figure_png, get_point, get_roi, indexes, \
+    pick_scale, precisions, session_figure
 
 
 def setup():
@@ -16,12 +10,12 @@ def setup():
     return "Initialization done."
 
 
-def plot_index_over_time(satellite, index_name, start_year, end_year, region, graph_data):
+def plot_index_over_time(satellite, index_name, start_year, end_year, region_json, region_key, graph_data, scale=30):
     years = list(range(start_year, end_year + 1))
     index_values_dict = {data: [] for data in graph_data}
 
-    for year in years:
-        index_image, stats = calc_index(satellite, index_name, year, region, False)
+    # All years are reduced server-side and returned by a single getInfo()
+    for stats in calc_index_timeseries(satellite, index_name, years, region_json, region_key, scale):
         for data in graph_data:
             index_values_dict[data].append(stats[f"{index_name}_{data.lower()}"])
 
@@ -29,7 +23,7 @@ def plot_index_over_time(satellite, index_name, start_year, end_year, region, gr
     for data in graph_data:
         df[data] = index_values_dict[data]
 
-    fig, ax = plt.subplots()
+    fig, ax = session_figure('graph_figure')
     for data in graph_data:
         ax.plot(df['Year'], df[data], marker='o', linestyle='-', label=f'{data} {index_name}')
 
@@ -50,7 +44,7 @@ def main():
     row1_col1, row1_col2 = st.columns([1, 1])
 
     roi = None
-    coordinates = None
+    coordinates = coordinates_json = coordinates_key = None
 
     st.sidebar.markdown("""---""")
     st.sidebar.markdown("<h5 style='text-align: center; color: grey;'>Set point of interest</h5>",
@@ -62,35 +56,21 @@ def main():
         lat = st.number_input('Latitude', value=0.0)
 
     if long != 0 and lat != 0:
-        coordinates = ee.Geometry.Point([long, lat])
+        coordinates, coordinates_json, coordinates_key = get_point(long, lat)
 
     st.sidebar.markdown("<h3 style='text-align: center; color: grey;'>OR</h3>", unsafe_allow_html=True)
 
     # Upload a zipped shapefile
     uploaded_shp_file = st.sidebar.file_uploader("Upload a Zipped Shapefile", type=["zip"])
 
+    st.sidebar.markdown("""---""")
+    precision = st.sidebar.select_slider("Precision", options=list(precisions.keys()), value='Balanced')
+
     if uploaded_shp_file is not None:
-        # Extract the zip file
-        with tempfile.TemporaryDirectory() as tmpdir:
-            with zipfile.ZipFile(uploaded_shp_file, 'r') as zip_ref:
-                zip_ref.extractall(tmpdir)
-
-            # Find the shapefile within the extracted files
-            shapefile_path = None
-            for root, dirs, files in os.walk(tmpdir):
-                for file in files:
-                    if file.endswith(".shp"):
-                        shapefile_path = os.path.join(root, file)
-                        break
-
-            if shapefile_path:
-                # Read the shapefile into a GeoDataFrame
-                gdf = gpd.read_file(shapefile_path)
-            else:
-                st.error("Shapefile (.shp) not found in the uploaded zip file.")
-
-            if not gdf.empty:
-                roi = geemap.geopandas_to_ee(gdf)
+        gdf, roi, roi_json, roi_key = get_roi(uploaded_shp_file)
+
+        if gdf is None:
+            st.error("Shapefile (.shp) not found in the uploaded zip file, or the zip file could not be read.")
 
     with row0_col1:
         sat = st.selectbox("Select a satellite", list(datasets.keys()), index=0)
@@ -110,17 +90,28 @@ def main():
         graph_data = st.multiselect("Data", ["Max", "Mean", "Min"], default=("Max", "Mean", "Min"))
 
     if coordinates is not None and roi is None:
-        region = coordinates
+        region, region_json, region_key = coordinates, coordinates_json, coordinates_key
     elif roi is not None:
-        region = roi
+        region, region_json, region_key = roi, roi_json, roi_key
     else:
-        region = None
+        region = region_json = region_key = None
+
+    # A single year has nothing to plot over time, so show its statistics directly
+    if start_year == end_year:
+        if graph_data is not None and region is not None:
+            summary = calc_index(sat, index_name, start_year, region_json, region_key, False, precision)
+            with row1_col1:
+                for data in graph_data:
+                    st.metric(f'{data} {index_name} ({start_year})', summary['stats'][f"{index_name}_{data.lower()}"])
+        return
 
     if start_year <= end_year:
         if graph_data is not None and region is not None:
-            fig, df = plot_index_over_time(sat, index_name, start_year, end_year, region, graph_data)
+            scale = pick_scale(region, region_key, precision)
+            fig, df = plot_index_over_time(sat, index_name, start_year, end_year, region_json, region_key,
+                                           graph_data, scale)
             with row1_col1:
-                st.pyplot(fig)
+                st.image(figure_png(fig))
             with row1_col2:
                 df['Year'] = df['Year'].astype(str)
                 st.write(df)